@@ -22,15 +22,33 @@ Usage: egg-octreefy [args] [-o outfile.egg] infile.egg [infile.egg...]
 -v     verbose
 -l     list resulting egg file
 -n     number of triangles per leaf (default 3)
-if outfile is not specified "infile"-octree.egg assumed
+-m     keep textures and materials (leaf triangles are grouped by them)
+       the leaves then both render and collide
+-f     output format, egg or bam (default egg)
+-z     compress the output file (adds .pz)
+-c     cut triangles along the split planes so leaves do not overlap
+-g     with -c stop cutting at this many times the triangles (default 2)
+if outfile is not specified "infile"-octree.egg (or .bam) assumed
+bam output is the loaded node tree, it needs no egg parsing at load time
+polygons of all groups are put in one octree and written with a single
+vertex pool holding only the vertices they use, transforms and instances are
+flattened first, of switch groups only the first child and of LOD groups only
+the most detailed level is used (with a warning)
 """
 import sys, getopt
 import math
+import re
 from pandac.PandaModules import *
-global verbose,listResultingEgg,maxNumber
+global verbose,listResultingEgg,maxNumber,keepMaterials
+global outputFormat,compress,clipTriangles,maxGrowth
 listResultingEgg = False
 verbose = False
 maxNumber = 3
+keepMaterials = False
+outputFormat = 'egg'
+compress = False
+clipTriangles = False
+maxGrowth = 2.0
    
 def getCenter(vertexList):
     """ get a list of Polywraps and figure out their center """
@@ -102,25 +120,111 @@ def genPolyWraps(group):
             pw.center = center
             yield pw
          
-def buildOctree(group):
-    """ build an octree form a egg group """
+def lerpVertex(a,b,t):
+    """ make a vertex in the pool of a that is between vertexes a and b """
+    vtx = EggVertex(a)
+    vtx.setPos(a.getPos3()+(b.getPos3()-a.getPos3())*t)
+    if a.hasNormal() and b.hasNormal():
+        normal = a.getNormal()+(b.getNormal()-a.getNormal())*t
+        normal.normalize()
+        vtx.setNormal(normal)
+    if a.hasUv() and b.hasUv():
+        vtx.setUv(a.getUv()+(b.getUv()-a.getUv())*t)
+    if a.hasColor() and b.hasColor():
+        vtx.setColor(a.getColor()+(b.getColor()-a.getColor())*t)
+    return a.getPool().createUniqueVertex(vtx)
+
+def clipPolyWrap(pw,axis,plane,clipStats):
+    """
+        cut the triangle of a poly wrap along a plane
+        and return poly wraps for the pieces
+    """
+    # a cut makes up to 2 extra triangles
+    if clipStats['triangles']+2 > clipStats['limit']:
+        return [pw]
+    vertexes = [i for i in iterVertexes(pw.polygon)]
+    sides = [vtx.getPos3()[axis]-plane for vtx in vertexes]
+    # vertexes close to the plane are on it, cutting
+    # the edges next to them would only make slivers
+    sides = [side if abs(side) > 1e-6 else 0 for side in sides]
+    if min(sides) >= 0 or max(sides) <= 0:
+        return [pw]
+    below = []
+    above = []
+    for i in xrange(len(vertexes)):
+        j = (i+1)%len(vertexes)
+        a = sides[i]
+        b = sides[j]
+        if a <= 0: below.append(vertexes[i])
+        if a >= 0: above.append(vertexes[i])
+        if (a < 0 and b > 0) or (a > 0 and b < 0):
+            vtx = lerpVertex(vertexes[i],vertexes[j],a/(a-b))
+            below.append(vtx)
+            above.append(vtx)
+    pieces = []
+    for vertexes in (below,above):
+        for k in xrange(1,len(vertexes)-1):
+            triangle = (vertexes[0],vertexes[k],vertexes[k+1])
+            points = [Point3(*vtx.getPos3()) for vtx in triangle]
+            if not CollisionPolygon.verifyPoints(*points): continue
+            polygon = EggPolygon(pw.polygon)
+            polygon.clear()
+            center = Vec3D()
+            for vtx in triangle:
+                polygon.addVertex(vtx)
+                center += vtx.getPos3()
+            piece = Polywrap()
+            piece.polygon = polygon
+            piece.center = center/3
+            pieces.append(piece)
+    if not pieces:
+        # keep the triangle whole rather than losing it
+        return [pw]
+    clipStats['clipped'] += 1
+    clipStats['triangles'] += len(pieces)-1
+    return pieces
+
+def clipPolyWraps(vertexList,center,clipStats):
+    """ cut the poly wraps along the 3 planes through center """
+    for axis in xrange(3):
+        pieces = []
+        for pw in vertexList:
+            pieces.extend(clipPolyWrap(pw,axis,center[axis],clipStats))
+        vertexList = pieces
+    return vertexList
+
+def buildOctree(group,clip=False,maxGrowth=2.0):
+    """
+        build an octree form a egg group, with clip triangles
+        are cut along the split planes until there are maxGrowth
+        times as many triangles as at the start
+    """
     global verbose
     group.triangulatePolygons(0xff)
     polywraps = [i for i in genPolyWraps(group)]
     if verbose: print len(polywraps),"triangles"
+    clipStats = None
+    if clip:
+        clipStats = {'clipped':0,'start':len(polywraps),
+            'triangles':len(polywraps),'limit':int(len(polywraps)*maxGrowth)}
     center = getCenter(polywraps)
+    if clip: polywraps = clipPolyWraps(polywraps,center,clipStats)
     quadrants = splitIntoQuadrants(polywraps,center)
     eg = EggGroup('octree-root')
-    for node in recr(quadrants):
+    for node in recr(quadrants,clipStats=clipStats):
         eg.addChild(node)
+    if verbose and clip:
+        print clipStats['clipped'],"triangles clipped, growth",
+        print float(clipStats['triangles'])/max(clipStats['start'],1)
     return eg
 
-def recr(quadrants,indent=0):
+def recr(quadrants,indent=0,clipStats=None):
     """
         visit each quadrent and create octree there
         all the end consolidate all octrees into egg groups
+        if clipStats is given triangles are clipped too
     """
-    global verbose,maxNumber
+    global verbose,maxNumber,keepMaterials
     qs = [i for i in quadrants]
     if verbose: print "    "*indent,"8 quadrents have ",[len(i) for i in qs]," triangles"
     for quadrent in qs:
@@ -131,14 +235,23 @@ def recr(quadrants,indent=0):
             center = getCenter(quadrent)
             if verbose: print "    "*indent," triangle center", center, len(quadrent)
             eg = EggGroup('leaf %i tri'%len(quadrent))
-            eg.addObjectType('barrier')
+            if keepMaterials:
+                # barrier would turn the polygons into collisions only
+                # keep them visible so one file renders and collides
+                eg.setCsType(EggGroup.CSTPolyset)
+                eg.setCollideFlags(EggGroup.CFDescend|EggGroup.CFKeep)
+            else:
+                eg.addObjectType('barrier')
+            # keep triangles with the same state next to each other
+            quadrent.sort(key=lambda pw: polyStateKey(pw.polygon))
             for pw in quadrent:
                 eg.addChild(pw.polygon)
-                if eg.getFirstChild : yield eg
+            if eg.getFirstChild : yield eg
         else:
             eg = EggGroup('branch-%i'%indent)
             center = getCenter(quadrent)
-            for node in recr(splitIntoQuadrants(quadrent,center),indent+1):
+            if clipStats is not None: quadrent = clipPolyWraps(quadrent,center,clipStats)
+            for node in recr(splitIntoQuadrants(quadrent,center),indent+1,clipStats):
                 eg.addChild(node)
             if eg.getFirstChild : yield eg
      
@@ -171,6 +284,15 @@ def eggLs(eggNode,indent=0):
         for eggChildren in iterChildren(eggNode):
             eggLs(eggChildren,indent+1)
        
+def polyStateKey(polygon):
+    """ textures and material of a polygon, used to group polygons by state """
+    textures = tuple([polygon.getTexture(i).getName()
+        for i in xrange(polygon.getNumTextures())])
+    material = ''
+    if polygon.hasMaterial():
+        material = polygon.getMaterial().getName()
+    return textures,material
+
 def eggStripTexture(eggNode):
     """ strip textures and materials """
     if eggNode.__class__ == EggPolygon:
@@ -181,6 +303,66 @@ def eggStripTexture(eggNode):
             eggStripTexture(eggChildren)
            
            
+def iterNodes(eggNode,types,choose=None):
+    """
+        iterate all nodes of the given types under a node, depth first
+        choose can pick which children of a node are visited
+    """
+    children = [i for i in iterChildren(eggNode)]
+    if choose: children = choose(eggNode,children)
+    for child in children:
+        if type(child) in types:
+            yield child
+        for node in iterNodes(child,types,choose):
+            yield node
+
+def lodSwitchOut(group):
+    """
+        switch out distance of a LOD group, the switch condition
+        has no getter for it so read it back from the egg syntax
+    """
+    stream = StringStream()
+    group.getLod().write(stream,0)
+    numbers = re.findall(r'[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?',stream.getData())
+    if len(numbers) < 2: return 0.0
+    return float(numbers[1])
+
+def chooseLevel(eggNode,children):
+    """
+        switch and LOD groups hold alternatives of the same thing,
+        putting all of them in the octree would merge every level
+        so only the first child of a switch group and the most
+        detailed (smallest switch out) LOD child are kept
+    """
+    if isinstance(eggNode,EggGroup) and eggNode.getSwitchFlag():
+        groups = [c for c in children if isinstance(c,EggGroup)]
+        if len(groups) > 1:
+            print "warning only using",groups[0].getName(),"of switch group",eggNode.getName()
+            children = [c for c in children
+                if not isinstance(c,EggGroup) or c is groups[0]]
+    lods = [c for c in children if isinstance(c,EggGroup) and c.hasLod()]
+    if len(lods) > 1:
+        best = min(lods,key=lodSwitchOut)
+        print "warning only using LOD",best.getName(),"of",eggNode.getName()
+        children = [c for c in children
+            if not (isinstance(c,EggGroup) and c.hasLod()) or c is best]
+    return children
+
+def compactVertexPool(eggNode,name='vpool'):
+    """
+        build a new vertex pool that only holds the vertices
+        used by polygons under eggNode, exact duplicates are
+        welded and the polygons are renumbered to match
+    """
+    vertexPool = EggVertexPool(name)
+    for polygon in iterNodes(eggNode,(EggPolygon,)):
+        vertexes = [vertexPool.createUniqueVertex(vtx)
+            for vtx in iterVertexes(polygon)]
+        polygon.clear()
+        for vtx in vertexes:
+            polygon.addVertex(vtx)
+    return vertexPool
+
 def octreefy(infile,outfile):
     """
         octreefy infile and write to outfile
@@ -188,38 +370,61 @@ def octreefy(infile,outfile):
     """
     egg = EggData()
     egg.read(Filename(infile))
-    eggStripTexture(egg)
-    group = egg
-    vertexPool = False
-    # find the fist group and fine the first vertexPool
-    # you might have to mess with this if your egg files
-    # are in odd format
-    for child in iterChildren(egg):
-        if type(child) == EggVertexPool:
-            vertexPool = child
-        if type(child) == EggGroup:
-            group = child
-    # if we have not found the vertexPool it must be inside
-    if not vertexPool:
-        for child in iterChildren(group):
-            if type(child) == EggVertexPool:
-                vertexPool = child
-    if vertexPool and group:
+    if not keepMaterials: eggStripTexture(egg)
+    # gather the polygons of every group and the definitions
+    # they use, no matter how the egg file is laid out, the
+    # polygons leave their groups so bake the transforms first
+    egg.flattenTransforms()
+    egg.triangulatePolygons(0xff)
+    pools = [i for i in iterNodes(egg,(EggVertexPool,))]
+    states = [i for i in iterNodes(egg,(EggTexture,EggMaterial))]
+    group = EggGroup('octree-source')
+    for polygon in [i for i in iterNodes(egg,(EggPolygon,),chooseLevel)]:
+        group.addChild(polygon)
+    if group.getFirstChild():
         ed = EggData()
         ed.setCoordinateSystem(egg.getCoordinateSystem())
+        if keepMaterials:
+            for state in states:
+                ed.addChild(state)
+        octree = buildOctree(group,clipTriangles,maxGrowth)
+        vertexPool = compactVertexPool(octree)
+        if verbose:
+            print sum([pool.size() for pool in pools]),"vertices in",
+            print len(pools),"pools compacted to",vertexPool.size()
         ed.addChild(vertexPool)
-        ed.addChild(buildOctree(group))
+        ed.addChild(octree)
         if listResultingEgg: eggLs(ed)
+        writeOctree(ed,outfile)
+    else:
+        print "error no polygons to octreefy in",infile
+
+def writeOctree(ed,outfile):
+    """
+        write the egg data in the output format, for bam
+        the scene graph is built here once instead of
+        every time the octree is loaded
+    """
+    if compress and not outfile.endswith('.pz'):
+        outfile += '.pz'
+    if outputFormat == 'bam':
+        node = loadEggData(ed)
+        if not node:
+            print "error could not convert octree to nodes"
+            return
+        NodePath(node).writeBamFile(Filename(outfile))
+    else:
         ed.writeEgg(Filename(outfile))
        
 def main():
     """ interface to our egg octreefier """
     try:
-        optlist, list = getopt.getopt(sys.argv[1:], 'hlvo:n:')
+        optlist, list = getopt.getopt(sys.argv[1:], 'hlvmzco:n:f:g:')
     except Exception,e:
         print e
         sys.exit(0)
-    global verbose,listResultingEgg,maxNumber
+    global verbose,listResultingEgg,maxNumber,keepMaterials
+    global outputFormat,compress,clipTriangles,maxGrowth
     outfile = False
     for opt in optlist:
         if opt[0] == '-h':
@@ -229,6 +434,16 @@ def main():
             listResultingEgg = True
         if opt[0] == '-v':
             verbose = True
+        if opt[0] == '-m':
+            keepMaterials = True
+        if opt[0] == '-z':
+            compress = True
+        if opt[0] == '-f':
+            outputFormat = opt[1]
+        if opt[0] == '-c':
+            clipTriangles = True
+        if opt[0] == '-g':
+            maxGrowth = float(opt[1])
         if opt[0] == '-n':
             maxNumber = int(opt[1])
         if opt[0] == '-o':
@@ -236,6 +451,9 @@ def main():
     if outfile and len(list) > 1:
         print "error can have an outfile and more then one infile"
         sys.exit(0)
+    if outputFormat not in ('egg','bam'):
+        print "error unknown output format",outputFormat
+        sys.exit(0)
        
     for file in list:
         if '.egg' in file:
@@ -243,7 +461,7 @@ def main():
             if outfile:
                 octreefy(file,outfile)
             else:
-                octreefy(file,file.replace(".egg","-octree.egg"))
+                octreefy(file,file.replace(".egg","-octree."+outputFormat))
                  
 if __name__ == "__main__":
     import os
@@ -27,8 +27,13 @@ with calculating polywrap centers.  I removed combine(), because I felt it was
 redundant.
 
 Usage:
-    newnode = octreefy (node, type='colpoly', maxDensity=64, verbose=0)
+    newnode = octreefy (node, type='colpoly', maxDensity=64, verbose=0,
+        keepState=False, clean=False, weld=False, cleanEpsilon=1e-4,
+        cleanArea=1e-8, stats=None, lod=False, lodGrid=4, lodFactor=4.0,
+        clip=False, maxGrowth=2.0)
     newnode = quadtreefy (...)   [same parameters as above]
+    build = octreefyAsync (node, callback=None, budget=0.002, ...)
+    build = quadtreefyAsync (...)   [same parameters as above]
 
 The input node is the node to be turned into an octree.  This can either be a
 GeomNode or a PandaNode with a GeomNode child.  Will create a quad/octree for
@@ -37,7 +42,35 @@ heirarchy first before you hand it over.  (If you want the old combiner method
 back, just copy the combine function over from Mindstormss's script.)
 
 The quad/octree is returned as a new node.  This node does not contain the
-original node's states, so you will need to assign as appropriate.
+original node's states, so you will need to assign as appropriate.  Pass
+keepState=True to carry them over instead: every Geom of the GeomNode is then
+partitioned (not just the first one) and each leaf keeps one Geom per render
+state, so textures and materials survive the split.
+
+With clean=True zero-area and duplicated triangles are dropped before
+partitioning.  Triangles with an area up to cleanArea are zero-area, and
+positions closer than about cleanEpsilon are the same.  Triangles only count
+as duplicates when they have the same winding, so the back faces of double
+sided walls survive (CollisionPolygons are one sided too).  weld=True also
+merges vertices that share a position; it ignores normals and texcoords, so use
+it for collision trees.  Pass a dict as stats to get the number of triangles
+and vertices that were removed.
+
+With lod=True (only for 'geom') every branch gets a simplified proxy of
+its triangles and an LODNode that shows the proxy instead of the branch when
+the camera is further than lodFactor times the radius of the branch.  The
+proxy is made by vertex clustering: the bounds of the branch are cut into
+lodGrid cells along each axis and all vertices in a cell are replaced by the
+first one.  As proxies of big branches replace the proxies of their children,
+the tree works as a hierarchical LOD.  The collision traverser would only see
+the proxies, so lod can not be combined with 'both'.
+
+Normally a triangle goes to the cell its center is in, so big triangles stick
+out of their cell and the bounds of neighbouring leaves overlap.  With
+clip=True triangles that cross a split plane are cut along it, which makes the
+leaf bounds disjoint and tight.  The cutting stops once there are maxGrowth
+times as many triangles as at the start; stats gets the number of 'clipped'
+triangles, the final number of 'triangles' and the 'growth' factor.
 
 Set verbose to 1 if you want to see a breakdown of what is returned.  Set it to
 2 if you would also like to see tight bounds plus a random color for each leaf.
@@ -46,8 +79,19 @@ The type parameter controls what kind of geometry is returned.  If it set to
 'geom', then a GeomNode with Primitives will be returned.  If it set to
 'colpoly', then CollisionPolygons are returned.  You want to use CollisionPolys
 if you intend to use this quad/octree for collisions, as it is much faster than
-using GeomNodes.
+using GeomNodes.  If it is set to 'both', each leaf gets a GeomNode and a
+CollisionNode, so one tree can be used for rendering and collisions (combine
+it with keepState=True to get a single asset for a whole level).
+
+The Async versions are for building while the game is running.  The space is
+partitioned in a thread and the nodes are made by a task that only spends
+budget seconds per frame (but makes at least one node each frame).  They return
+a TreeBuild: check progress or done(), call cancel() to stop it, and get the
+tree from result() or the callback.  The task manager and threading modules
+are only imported when one of them is used.
 """
+from pandac.PandaModules import *
+import random
 
 def getCenter(vertexList):
     """ Get a list of Polywraps and figure out their center """
@@ -119,12 +163,14 @@ class Polywrap:
     """
     polygon = None
     center = None
+    vertices = None
+    batch = 0
 
     def __str__(self):
         """ Some visualization to aid debugging """
-        return str(self.polygon.getNumVertices())+":"+str(self.center)
+        return str(len(self.vertices))+":"+str(self.center)
 
-def genPolyWraps(vdata, prim):
+def genPolyWraps(vdata, prim, batch=0):
     """ Generate a list of polywraps from a group of polygons """
     vertex = GeomVertexReader(vdata, 'vertex')
     for p in range(prim.getNumPrimitives()):
@@ -132,26 +178,377 @@ def genPolyWraps(vdata, prim):
         e = prim.getPrimitiveEnd(p)
         center = Vec3(0)
         num = 0
+        vertices = []
         for i in range(s, e):
-            vertex.setRow(prim.getVertex(i))
+            vertices.append(prim.getVertex(i))
+            vertex.setRow(vertices[-1])
             center+=vertex.getData3f()
         center/=e-s
         pw = Polywrap()
         pw.polygon = p
         pw.center = center
+        pw.vertices = vertices
+        pw.batch = batch
         yield pw
 
-def recr(quadrants, vdata, prim, type, maxDensity, verbose, quadsplitter, \
-        indent=0):
+def cleanPolyWraps(polywraps, batches, weld=False, stats=None, \
+        epsilon=1e-4, area=1e-8):
+    """
+    Drop triangles with an area up to area and duplicated triangles before
+    partitioning, optionally welding vertices with the same position first.
+    Positions are rounded to a grid of epsilon, so points closer than epsilon
+    count as equal, though two near points on either side of a grid line do
+    not.  Duplicates must have the same winding.  Returns the polywraps that
+    are kept and adds the number of 'degenerate' and 'duplicate' triangles
+    and 'welded' vertices to stats.
+    """
+    if stats is None:
+        stats = {}
+    for key in ('degenerate', 'duplicate', 'welded'):
+        stats.setdefault(key, 0)
+    readers = [GeomVertexReader(vdata, 'vertex') for vdata, prim, state in batches]
+    firstRows = [{} for b in batches]
+    welded = set()
+    seen = set()
+    kept = []
+    for pw in polywraps:
+        vertex = readers[pw.batch]
+        points = []
+        keys = []
+        for i, row in enumerate(pw.vertices):
+            vertex.setRow(row)
+            point = Point3(vertex.getData3f())
+            key = tuple([int(round(x/epsilon)) for x in point])
+            if weld:
+                first = firstRows[pw.batch].setdefault(key, row)
+                if first != row:
+                    pw.vertices[i] = first
+                    welded.add((pw.batch, row))
+            points.append(point)
+            keys.append(key)
+        size = (points[1]-points[0]).cross(points[2]-points[0]).length()/2
+        if size <= area or len(set(pw.vertices)) < 3:
+            stats['degenerate'] += 1
+            continue
+        # rotate the smallest key first, this keeps the winding
+        first = keys.index(min(keys))
+        keys = keys[first:]+keys[:first]
+        key = (pw.batch, tuple(keys))
+        if key in seen:
+            stats['duplicate'] += 1
+            continue
+        seen.add(key)
+        kept.append(pw)
+    stats['welded'] += len(welded)
+    return kept
+
+class ClipSplitter:
+    """
+        Wraps a quadrant splitting function, so that triangles crossing the
+        split planes are cut along them before they are put into quadrants.
+        New vertices are added to the vertex data of the batches, so these
+        must be private copies.  Call finish() once the tree is built to drop
+        the rows that were allocated but not used.
+    """
+    epsilon = 1e-6
+
+    def __init__(self, quadsplitter, axes, batches, numTriangles, maxGrowth, \
+            stats):
+        self.quadsplitter = quadsplitter
+        self.axes = axes
+        self.batches = batches
+        self.start = max(numTriangles, 1)
+        self.limit = int(numTriangles*maxGrowth)
+        self.stats = stats
+        # batch -> [used rows, allocated rows, rewriters, vertex rewriter]
+        self.rows = {}
+        stats['clipped'] = 0
+        stats['triangles'] = numTriangles
+        stats['growth'] = 1.0
+
+    def __call__(self, vertexList, center):
+        for axis in self.axes:
+            pieces = []
+            for pw in vertexList:
+                pieces.extend(self.clip(pw, axis, center[axis]))
+            vertexList = pieces
+        self.stats['growth'] = float(self.stats['triangles'])/self.start
+        return self.quadsplitter(vertexList, center)
+
+    def clip(self, pw, axis, plane):
+        """ Cut a polywrap along a plane, returns the pieces """
+        # a cut makes up to 2 extra triangles
+        if self.stats['triangles']+2 > self.limit:
+            return [pw]
+        vertex = self.getRows(pw.batch)[3]
+        points = {}
+        for row in pw.vertices:
+            vertex.setRow(row)
+            points[row] = Point3(vertex.getData3f())
+        sides = []
+        for row in pw.vertices:
+            side = points[row][axis]-plane
+            # vertices close to the plane are on it, cutting the edges next
+            # to them would only make slivers
+            if abs(side) <= self.epsilon:
+                side = 0
+            sides.append(side)
+        if min(sides) >= 0 or max(sides) <= 0:
+            return [pw]
+        below = []
+        above = []
+        for i in range(3):
+            j = (i+1)%3
+            a = sides[i]
+            b = sides[j]
+            if a <= 0: below.append(pw.vertices[i])
+            if a >= 0: above.append(pw.vertices[i])
+            if (a < 0 and b > 0) or (a > 0 and b < 0):
+                t = a/(a-b)
+                row = self.lerpRow(pw.batch, pw.vertices[i], pw.vertices[j], t)
+                points[row] = points[pw.vertices[i]] + \
+                    (points[pw.vertices[j]]-points[pw.vertices[i]])*t
+                below.append(row)
+                above.append(row)
+        pieces = []
+        for polygon in (below, above):
+            for k in range(1, len(polygon)-1):
+                rows = [polygon[0], polygon[k], polygon[k+1]]
+                if not CollisionPolygon.verifyPoints( \
+                        *[points[row] for row in rows]):
+                    continue
+                piece = Polywrap()
+                piece.vertices = rows
+                piece.center = Vec3(0)
+                for row in rows:
+                    piece.center += points[row]
+                piece.center /= 3
+                piece.batch = pw.batch
+                pieces.append(piece)
+        if not pieces:
+            # keep the triangle whole rather than losing it
+            return [pw]
+        self.stats['clipped'] += 1
+        self.stats['triangles'] += len(pieces)-1
+        return pieces
+
+    def getRows(self, batch, grow=False):
+        """
+        The row bookkeeping of a batch.  With grow the vertex data gets room
+        for more rows, the rewriters are made again after that, as the old
+        ones point to the old arrays.
+        """
+        rows = self.rows.get(batch)
+        if rows and not grow:
+            return rows
+        vdata = self.batches[batch][0]
+        if rows:
+            used = rows[0]
+            allocated = used + max(64, used/2)
+            vdata.setNumRows(allocated)
+        else:
+            used = allocated = vdata.getNumRows()
+        format = vdata.getFormat()
+        rewriters = []
+        for i in range(format.getNumColumns()):
+            rewriters.append(GeomVertexRewriter(vdata, \
+                format.getColumn(i).getName()))
+        rows = [used, allocated, rewriters, GeomVertexReader(vdata, 'vertex')]
+        self.rows[batch] = rows
+        return rows
+
+    def lerpRow(self, batch, a, b, t):
+        """ Add a row to a batch that is between rows a and b in every column """
+        rows = self.getRows(batch)
+        if rows[0] == rows[1]:
+            rows = self.getRows(batch, True)
+        row = rows[0]
+        for rewriter in rows[2]:
+            rewriter.setRow(a)
+            va = rewriter.getData4f()
+            rewriter.setRow(b)
+            vb = rewriter.getData4f()
+            rewriter.setRow(row)
+            rewriter.setData4f(va + (vb-va)*t)
+        rows[0] += 1
+        return row
+
+    def finish(self):
+        """ Drop the rows that were allocated but not used """
+        for batch, rows in self.rows.items():
+            if rows[0] != rows[1]:
+                self.batches[batch][0].setNumRows(rows[0])
+        self.rows = {}
+
+def getBatches(geomNode, keepState):
+    """
+    Collect the triangles of a GeomNode as a list of (vdata, prim, state)
+    batches.  Without keepState only the first Geom is used, as before.
+    Primitives that are not triangles after decompose() are left out.
+    """
+    batches = []
+    if keepState:
+        numGeoms = geomNode.getNumGeoms()
+    else:
+        numGeoms = 1
+    for g in range(numGeoms):
+        geom = geomNode.getGeom(g).decompose()
+        if keepState:
+            state = geomNode.getGeomState(g)
+            numPrims = geom.getNumPrimitives()
+        else:
+            state = RenderState.makeEmpty()
+            numPrims = 1
+        for i in range(numPrims):
+            prim = geom.getPrimitive(i)
+            # lines and points can not be put into triangle leaves
+            if not prim.isOfType(GeomTriangles.getClassType()):
+                continue
+            batches.append((geom.getVertexData(), prim, state))
+    return batches
+
+def makeLeaf(quadrant, batches, type, verbose, indent=0):
+    """
+    Turn the polywraps of a quadrant into a leaf NodePath.  Triangles are
+    grouped by batch, so a leaf holds one Geom per render state.
+    """
+    node = NodePath('leaf-%i'%indent)
+    byBatch = {}
+    for pw in quadrant:
+        byBatch.setdefault(pw.batch, []).append(pw)
+    if type in ('geom', 'both'):
+        geomNode = GeomNode('gnode')
+        for batch in sorted(byBatch):
+            vdata, prim, state = batches[batch]
+            p = GeomTriangles(Geom.UHStatic)
+            for pw in byBatch[batch]:
+                p.addVertices(*pw.vertices)
+                p.closePrimitive()
+            geom = Geom(vdata)
+            geom.addPrimitive(p)
+            geomNode.addGeom(geom, state)
+        node.attachNewNode(geomNode)
+    if type in ('colpoly', 'both'):
+        colNode = CollisionNode('leaf-%i'%indent)
+        for batch in sorted(byBatch):
+            vertex = GeomVertexReader(batches[batch][0], 'vertex')
+            for pw in byBatch[batch]:
+                l = pw.vertices
+                for i in range(0,len(l),3):
+                    v = []
+                    for i2 in range(3):
+                        vertex.setRow(l[i+i2])
+                        v.append(Point3(vertex.getData3f()))
+                    if not CollisionPolygon.verifyPoints(*v): continue
+                    p = CollisionPolygon(*v)
+                    colNode.addSolid(p)
+        node.attachNewNode(colNode)
+    if verbose>1:
+        if type is not 'colpoly':
+            node.setColor (random.uniform(0,1), random.uniform(0,1), \
+                random.uniform(0,1), 1)
+        node.showTightBounds()
+    return node
+
+def clusterProxy(quadrant, batches, grid):
+    """
+    Simplify the triangles of a quadrant by vertex clustering.  The bounds
+    are cut into grid cells along each axis and every vertex is replaced by
+    the first vertex of the same batch found in its cell.  Triangles that
+    collapse or become duplicates (with the same winding) are dropped.
+    Makes no PandaNodes, so it can
+    run in a thread.  Returns a dict of batch -> list of row triples and the
+    center and radius of the bounds.
+    """
+    points = {}
+    lo = None
+    hi = None
+    for pw in quadrant:
+        vertex = GeomVertexReader(batches[pw.batch][0], 'vertex')
+        for row in pw.vertices:
+            vertex.setRow(row)
+            point = Point3(vertex.getData3f())
+            points[(pw.batch, row)] = point
+            if lo is None:
+                lo = Point3(point)
+                hi = Point3(point)
+            for i in range(3):
+                lo[i] = min(lo[i], point[i])
+                hi[i] = max(hi[i], point[i])
+    size = [max(hi[i]-lo[i], 1e-6)/grid for i in range(3)]
+    firstRows = {}
+    triangles = {}
+    for pw in quadrant:
+        rows = []
+        for row in pw.vertices:
+            point = points[(pw.batch, row)]
+            cell = tuple([min(int((point[i]-lo[i])/size[i]), grid-1) \
+                for i in range(3)])
+            rows.append(firstRows.setdefault((pw.batch, cell), row))
+        if len(set(rows)) < 3:
+            continue
+        # rotate the smallest row first, this keeps the winding
+        first = rows.index(min(rows))
+        key = tuple(rows[first:]+rows[:first])
+        triangles.setdefault(pw.batch, {}).setdefault(key, rows)
+    for batch in triangles:
+        triangles[batch] = triangles[batch].values()
+    return triangles, (lo+hi)/2, (hi-lo).length()/2
+
+def makeProxy(triangles, batches):
+    """ Make the proxy GeomNode from the triangles of clusterProxy """
+    geomNode = GeomNode('proxy')
+    for batch in sorted(triangles):
+        vdata, prim, state = batches[batch]
+        p = GeomTriangles(Geom.UHStatic)
+        for rows in triangles[batch]:
+            p.addVertices(*rows)
+            p.closePrimitive()
+        geom = Geom(vdata)
+        geom.addPrimitive(p)
+        geomNode.addGeom(geom, state)
+    return geomNode
+
+def makeBranch(quadrant, batches, type, verbose, indent=0, lod=None, \
+        proxy=None):
+    """
+    Make the NodePath for a branch.  Returns the branch and the NodePath the
+    children should be added to, which is only different when lod is a
+    (lodGrid, lodFactor) tuple.  proxy is the result of clusterProxy if that
+    was already done.
+    """
+    node = NodePath('branch-%i'%indent)
+    parent = node
+    if lod and type is 'geom':
+        grid, factor = lod
+        if proxy is None:
+            proxy = clusterProxy(quadrant, batches, grid)
+        triangles, center, radius = proxy
+        lodNode = LODNode('lod-%i'%indent)
+        lodNode.setCenter(center)
+        lodNode.addSwitch(factor*radius, 0)
+        lodNode.addSwitch(1e30, factor*radius)
+        lodPath = node.attachNewNode(lodNode)
+        parent = lodPath.attachNewNode('detail')
+        lodPath.attachNewNode(makeProxy(triangles, batches))
+    if verbose>1:
+        if type is not 'colpoly':
+            node.setColor (random.uniform(0,1), random.uniform(0,1), \
+                random.uniform(0,1), 1)
+        node.showTightBounds()
+    return node, parent
+
+def recr(quadrants, batches, type, maxDensity, verbose, quadsplitter, \
+        indent=0, lod=None):
     """
     Visit each quadrant and create a tree.
 
     quadrants = iterator of quadrants that have been generated for this
         branch
 
-    vdata,prim = data carried over from initial combine
+    batches = list of (vdata, prim, state) the polywraps refer to
 
-    type = 'geom' or 'colpoly', indicates what kind of PandaNodes to
+    type = 'geom', 'colpoly' or 'both', indicates what kind of PandaNodes to
         generate
 
     maxDensity = How many triangles to allow per leaf
@@ -160,8 +557,9 @@ def recr(quadrants, vdata, prim, type, maxDensity, verbose, quadsplitter, \
 
     quadsplitter = The quadrant space splitting function (can be quadtree or
         octree)
+
+    lod = None or (lodGrid, lodFactor) to give branches LOD proxies
     """
-    vertex = GeomVertexReader(vdata,'vertex')
     qs = [i for i in quadrants]
     if verbose: print "    "*indent,len(qs),"quadrants have ",[len(i) for i in qs]," triangles"
     for quadrant in qs:
@@ -171,73 +569,179 @@ def recr(quadrants, vdata, prim, type, maxDensity, verbose, quadsplitter, \
         elif len(quadrant) <= maxDensity:
             center = getCenter(quadrant)
             if verbose: print "    "*indent," triangle center", center, len(quadrant)
-            p = GeomTriangles(Geom.UHStatic)
-            if type is 'colpoly':
-                colNode = CollisionNode('leaf-%i'%indent)
-            for pw in quadrant:
-                s = prim.getPrimitiveStart(pw.polygon)
-                e = prim.getPrimitiveEnd(pw.polygon)
-                l = []
-                for i in range(s,e):
-                    l.append(prim.getVertex(i))
-                if type is 'geom':
-                    p.addVertices(*l)
-                    p.closePrimitive()
-                elif type is 'colpoly':
-                    for i in range(0,len(l),3):
-                        v = []
-                        for i2 in range(3):
-                            vertex.setRow(l[i+i2])
-                            v.append(vertex.getData3f())
-                        p = CollisionPolygon(*v)
-                        colNode.addSolid(p)
-
-            node = NodePath('leaf-%i'%indent)
-            if type is 'geom':
-                geom = Geom(vdata)
-                geom.clearPrimitives()
-                geom.addPrimitive(p)
-                geomNode = GeomNode('gnode')
-                geomNode.addGeom(geom)
-                node.attachNewNode(geomNode)
-            elif type is 'colpoly':
-                node.attachNewNode(colNode)
-            if verbose>1:
-                if type is 'geom':
-                    node.setColor (random.uniform(0,1), random.uniform(0,1), \
-                        random.uniform(0,1), 1)
-                node.showTightBounds()
-            yield node
+            yield makeLeaf(quadrant, batches, type, verbose, indent)
         else:
-            node = NodePath('branch-%i'%indent)
+            node, parent = makeBranch(quadrant, batches, type, verbose, \
+                indent, lod)
             center = getCenter(quadrant)
-            for n in recr(quadsplitter(quadrant,center), vdata, prim, type, \
-                                maxDensity, verbose, quadsplitter, indent+1):
-                n.reparentTo(node)
-            if verbose>1:
-                if type is 'geom':
-                    node.setColor (random.uniform(0,1), random.uniform(0,1), \
-                        random.uniform(0,1), 1)
-                node.showTightBounds()
+            for n in recr(quadsplitter(quadrant,center), batches, type, \
+                        maxDensity, verbose, quadsplitter, indent+1, lod):
+                n.reparentTo(parent)
             yield node
 
-def octreefy(node, type='geom', maxDensity=4, verbose=0, \
-    normal=False, texcoord=False, binormal=False):
+def buildPlan(quadrants, maxDensity, quadsplitter, cancelled=None, \
+        batches=None, lod=None):
     """
-    Octreefy this node and it's children.
+    Partition the quadrants the same way recr does, but without making any
+    PandaNodes, so it can run in a thread.  Returns a list of
+    (quadrant, children, proxy) where children is None for a leaf or another
+    such list for a branch.
 
-    type = 'geom' or 'colpoly'.  Will generate either GeomNodes or
-        CollisionPolys.
+    cancelled = optional function, the partitioning stops early when it
+        returns True
 
-    maxDensity = How 'deep' to make the tree, will make sure each leaf has
-        no more than X triangles in it
+    batches, lod = when lod is given the LOD proxy of every branch is
+        clustered here as well, proxy is None otherwise
+    """
+    plan = []
+    for quadrant in quadrants:
+        if cancelled and cancelled():
+            break
+        if len(quadrant) == 0:
+            continue
+        elif len(quadrant) <= maxDensity:
+            plan.append((quadrant, None, None))
+        else:
+            proxy = None
+            if lod:
+                proxy = clusterProxy(quadrant, batches, lod[0])
+            center = getCenter(quadrant)
+            plan.append((quadrant, buildPlan(quadsplitter(quadrant,center), \
+                maxDensity, quadsplitter, cancelled, batches, lod), proxy))
+    return plan
 
-    verbose = Enable some debugging info, set to 1 for console output, 2
-        for debug info
+class TreeBuild:
+    """
+        A quad/octree that is being built in the background, as returned by
+        octreefyAsync and quadtreefyAsync.  progress goes from 0 to 1 as
+        the triangles get emitted into the tree, stats is filled in like
+        the stats of octreefy.
+    """
+    progress = 0.0
+    error = None
+
+    def __init__(self, batches, type, maxDensity, verbose, prepare, lod, \
+            root, budget, callback, stats):
+        self.batches = batches
+        self.type = type
+        self.maxDensity = maxDensity
+        self.verbose = verbose
+        self.prepare = prepare
+        self.lod = lod
+        self.stats = stats
+        self.root = root
+        self.budget = budget
+        self.callback = callback
+        self.plan = None
+        self.stack = None
+        self.total = 0
+        self.emitted = 0
+        self.cancelled = False
+        self.finished = False
+        # imported here, so the synchronous functions do not need the
+        # task manager
+        from direct.stdpy import threading
+        from direct.task.TaskManagerGlobal import taskMgr
+        self.thread = threading.Thread(target=self.partition)
+        self.thread.start()
+        self.task = taskMgr.add(self.emitTask, 'build-%s'%root.getName())
+
+    def partition(self):
+        """ Worker thread: make the polywraps and partition them """
+        try:
+            polywraps, quadsplitter = self.prepare()
+            center = getCenter(polywraps)
+            lod = None
+            if self.type is 'geom':
+                lod = self.lod
+            plan = buildPlan(quadsplitter(polywraps, center), \
+                self.maxDensity, quadsplitter, self.isCancelled, \
+                self.batches, lod)
+            if isinstance(quadsplitter, ClipSplitter):
+                quadsplitter.finish()
+                self.total = self.stats['triangles']
+            else:
+                self.total = len(polywraps)
+            self.plan = plan
+        except Exception, e:
+            self.error = e
+            self.plan = []
+
+    def isCancelled(self):
+        return self.cancelled
+
+    def emitTask(self, task):
+        """
+        Main thread: turn the plan into nodes until the budget is used, but
+        always at least one entry per frame
+        """
+        from direct.task import Task
+        if self.cancelled:
+            return Task.done
+        if self.plan is None:
+            return Task.cont
+        if self.stack is None:
+            if self.verbose and self.stats: print self.stats
+            if self.verbose: print self.total, 'triangles in polywraps'
+            self.stack = [(self.root, list(self.plan), 0)]
+        clock = ClockObject.getGlobalClock()
+        deadline = clock.getRealTime() + self.budget
+        while self.stack:
+            parent, entries, indent = self.stack[-1]
+            if not entries:
+                self.stack.pop()
+                continue
+            quadrant, children, proxy = entries.pop(0)
+            if children is None:
+                makeLeaf(quadrant, self.batches, self.type, self.verbose, \
+                    indent).reparentTo(parent)
+                self.emitted += len(quadrant)
+                self.progress = float(self.emitted)/max(self.total, 1)
+            else:
+                node, branch = makeBranch(quadrant, self.batches, self.type, \
+                    self.verbose, indent, self.lod, proxy)
+                node.reparentTo(parent)
+                self.stack.append((branch, list(children), indent+1))
+            if clock.getRealTime() >= deadline:
+                break
+        if self.stack:
+            return Task.cont
+        self.finished = True
+        self.progress = 1.0
+        if self.error:
+            print 'Building', self.root.getName(), 'failed:', self.error
+        if self.callback:
+            self.callback(self.result())
+        return Task.done
+
+    def cancel(self):
+        """ Stop building, the callback will not be called """
+        from direct.task.TaskManagerGlobal import taskMgr
+        self.cancelled = True
+        taskMgr.remove(self.task)
+
+    def done(self):
+        return self.finished
+
+    def result(self):
+        """ The finished tree, or None if it is not done or failed """
+        if self.finished and not self.error:
+            return self.root
+        return None
+
+def prepareTree(node, rootName, type, keepState, clip, lod):
+    """
+    The setup shared by octreefy, quadtreefy and buildAsync: check the type
+    and lod, find the GeomNode and collect its batches (copied when clip will add
+    vertices to them).  Returns (batches, root NodePath) or None on an error.
     """
     # Sanity check
-    if type is not 'geom' and type is not 'colpoly':
-        print 'Unknown type of',type,',only geom or colpoly allowed!'
+    if type not in ('geom', 'colpoly', 'both'):
+        print 'Unknown type of',type,',only geom, colpoly or both allowed!'
+        return
+    if lod and type is 'both':
+        # the collision traverser would only visit the proxies
+        print 'lod can not be used with both, only with geom!'
         return
 
     # Let's look for a GeomNode under this nodepath.
@@ -250,76 +754,222 @@ def octreefy(node, type='geom', maxDensity=4, verbose=0, \
     if not geomNode.isGeomNode():
         print 'We require a single GeomNode.  Flatten first!'
         return
-    geom = geomNode.getGeom(0).decompose()
-    vdata = geom.getVertexData()
-    prim = geom.getPrimitive(0)
+    batches = getBatches(geomNode, keepState)
+    if clip:
+        # Clipping adds vertices, so work on copies
+        batches = [(GeomVertexData(vdata), prim, state) \
+            for vdata, prim, state in batches]
+
+    root = NodePath(PandaNode(rootName))
+    if keepState:
+        root.node().setState(geomNode.getState())
+    return batches, root
+
+def splitAxes(quadsplitter):
+    """ The axes the splitting planes of a quadrant splitter are on """
+    if quadsplitter is splitInto2DQuads:
+        return (0, 1)
+    return (0, 1, 2)
+
+def preparePolyWraps(batches, quadsplitter, clean, weld, cleanEpsilon, \
+        cleanArea, clip, maxGrowth, stats):
+    """
+    Make the polywraps of the batches and run the clean pre-pass if asked.
+    Returns the polywraps and the splitting function to use, which is a
+    ClipSplitter around quadsplitter with clip.
+    """
+    polywraps = []
+    for batch, (vdata, prim, state) in enumerate(batches):
+        polywraps.extend(genPolyWraps(vdata, prim, batch))
+    if clean:
+        polywraps = cleanPolyWraps(polywraps, batches, weld, stats, \
+            cleanEpsilon, cleanArea)
+    splitter = quadsplitter
+    if clip:
+        splitter = ClipSplitter(quadsplitter, splitAxes(quadsplitter), \
+            batches, len(polywraps), maxGrowth, stats)
+    return polywraps, splitter
+
+def octreefy(node, type='geom', maxDensity=4, verbose=0, \
+    normal=False, texcoord=False, binormal=False, keepState=False, \
+    clean=False, weld=False, cleanEpsilon=1e-4, cleanArea=1e-8, stats=None, \
+    lod=False, lodGrid=4, lodFactor=4.0, clip=False, maxGrowth=2.0):
+    """
+    Octreefy this node and it's children.
+
+    type = 'geom', 'colpoly' or 'both'.  Will generate either GeomNodes,
+        CollisionPolys or a GeomNode and a CollisionNode in every leaf.
+
+    maxDensity = How 'deep' to make the tree, will make sure each leaf has
+        no more than X triangles in it
+
+    verbose = Enable some debugging info, set to 1 for console output, 2
+        for debug info
+
+    keepState = Partition every Geom of the GeomNode and keep the render
+        states (textures, materials, ...) of the Geoms and the GeomNode
+
+    clean = Drop zero-area and duplicated triangles (with the same winding)
+        before partitioning
+
+    cleanEpsilon, cleanArea = Positions closer than cleanEpsilon are the
+        same, triangles with an area up to cleanArea are zero-area
+
+    weld = Also merge vertices with the same position (for collisions)
+
+    stats = Optional dict, gets the counts of what clean removed
+
+    lod = Give every branch a simplified proxy that is shown from further
+        than lodFactor times the branch radius, lodGrid is the number of
+        vertex clustering cells along each axis (not with type 'both')
+
+    clip = Cut triangles along the split planes so leaves do not overlap,
+        until there are maxGrowth times as many triangles as at the start
+    """
+    prepared = prepareTree(node, 'octree-root', type, keepState, clip, lod)
+    if not prepared:
+        return
+    batches, node = prepared
+    if verbose and keepState: print len(batches), 'render state batches'
 
     # Generate polywraps for our vertices
-    polywraps = [i for i in genPolyWraps(vdata,prim)]
+    if stats is None: stats = {}
+    polywraps, splitter = preparePolyWraps(batches, splitIntoQuadrants, clean, \
+        weld, cleanEpsilon, cleanArea, clip, maxGrowth, stats)
+    if verbose and clean: print stats
     if verbose: print len(polywraps),"triangles in polywraps"
 
     # Find the center of the entire mess
     center = getCenter(polywraps)
 
     # Do first split
-    quadrants = splitIntoQuadrants(polywraps, center)
+    quadrants = splitter(polywraps, center)
 
     # Now let's start working our way down the tree
-    node = NodePath(PandaNode('octree-root'))
-    for n in recr(quadrants, vdata, prim, type, maxDensity, verbose, splitIntoQuadrants):
+    if lod: lod = (lodGrid, lodFactor)
+    for n in recr(quadrants, batches, type, maxDensity, verbose, \
+            splitter, 0, lod):
         n.reparentTo(node)
+    if clip: splitter.finish()
+    if verbose and clip: print stats
 
     return node
 
 
 def quadtreefy(node, type='geom', maxDensity=4, verbose=0, \
-    normal=False, texcoord=False, binormal=False):
+    normal=False, texcoord=False, binormal=False, keepState=False, \
+    clean=False, weld=False, cleanEpsilon=1e-4, cleanArea=1e-8, stats=None, \
+    lod=False, lodGrid=4, lodFactor=4.0, clip=False, maxGrowth=2.0):
     """
     quadtreefy this node and it's children.
 
-    type = 'geom' or 'colpoly'.  Will generate either GeomNodes or
-        CollisionPolys.
+    type = 'geom', 'colpoly' or 'both'.  Will generate either GeomNodes,
+        CollisionPolys or a GeomNode and a CollisionNode in every leaf.
 
     maxDensity = How 'deep' to make the tree, will make sure each leaf has
         no more than X triangles in it
 
     verbose = Enable some debugging info, set to 1 for console output, 2
         for debug info
-    """
-    # Sanity check
-    if type is not 'geom' and type is not 'colpoly':
-        print 'Unknown type of',type,',only geom or colpoly allowed!'
-        return
 
-    # Let's look for a GeomNode under this nodepath.
-    # We don't search too deep, only checking the first child, because we are
-    # expecting a flattened structure.
-    if not node.node().isGeomNode():
-        geomNode = node.getChild(0).node() # Try to get first child
-    else:
-        geomNode = node.node()
-    if not geomNode.isGeomNode():
-        print 'We require a single GeomNode.  Flatten first!'
+    keepState = Partition every Geom of the GeomNode and keep the render
+        states (textures, materials, ...) of the Geoms and the GeomNode
+
+    clean = Drop zero-area and duplicated triangles (with the same winding)
+        before partitioning
+
+    cleanEpsilon, cleanArea = Positions closer than cleanEpsilon are the
+        same, triangles with an area up to cleanArea are zero-area
+
+    weld = Also merge vertices with the same position (for collisions)
+
+    stats = Optional dict, gets the counts of what clean removed
+
+    lod = Give every branch a simplified proxy that is shown from further
+        than lodFactor times the branch radius, lodGrid is the number of
+        vertex clustering cells along each axis (not with type 'both')
+
+    clip = Cut triangles along the split planes so leaves do not overlap,
+        until there are maxGrowth times as many triangles as at the start
+    """
+    prepared = prepareTree(node, 'quadtree-root', type, keepState, clip, lod)
+    if not prepared:
         return
-    geom = geomNode.getGeom(0).decompose()
-    vdata = geom.getVertexData()
-    prim = geom.getPrimitive(0)
+    batches, node = prepared
+    if verbose and keepState: print len(batches), 'render state batches'
 
     # Generate polywraps for our vertices
-    polywraps = [i for i in genPolyWraps(vdata, prim)]
-    if verbose: print len(polywraps), 'triangles in polywraps'
+    if stats is None: stats = {}
+    polywraps, splitter = preparePolyWraps(batches, splitInto2DQuads, clean, \
+        weld, cleanEpsilon, cleanArea, clip, maxGrowth, stats)
+    if verbose and clean: print stats
+    if verbose: print len(polywraps),"triangles in polywraps"
 
     # Find the center of the entire mess
     center = getCenter(polywraps)
     if verbose: print center, 'is center'
 
     # Do first split
-    quadrants = splitInto2DQuads(polywraps, center)
+    quadrants = splitter(polywraps, center)
 
     # Now let's start working our way down the tree
-    node = NodePath(PandaNode('quadtree-root'))
-    for n in recr(quadrants, vdata, prim, type, maxDensity, verbose, splitInto2DQuads):
+    if lod: lod = (lodGrid, lodFactor)
+    for n in recr(quadrants, batches, type, maxDensity, verbose, \
+            splitter, 0, lod):
         n.reparentTo(node)
+    if clip: splitter.finish()
+    if verbose and clip: print stats
 
     return node
 
+
+def buildAsync(node, rootName, quadsplitter, type, maxDensity, verbose, \
+    keepState, clean, weld, cleanEpsilon, cleanArea, lod, clip, maxGrowth, \
+    budget, callback):
+    """ Common part of octreefyAsync and quadtreefyAsync """
+    prepared = prepareTree(node, rootName, type, keepState, clip, lod)
+    if not prepared:
+        return
+    batches, root = prepared
+    stats = {}
+    def prepare():
+        return preparePolyWraps(batches, quadsplitter, clean, weld, \
+            cleanEpsilon, cleanArea, clip, maxGrowth, stats)
+    return TreeBuild(batches, type, maxDensity, verbose, prepare, lod, root, \
+        budget, callback, stats)
+
+def octreefyAsync(node, callback=None, budget=0.002, type='geom', \
+    maxDensity=4, verbose=0, keepState=False, clean=False, weld=False, \
+    cleanEpsilon=1e-4, cleanArea=1e-8, lod=False, lodGrid=4, lodFactor=4.0, \
+    clip=False, maxGrowth=2.0):
+    """
+    Octreefy this node in the background, returns a TreeBuild.
+
+    callback = Called with the octree NodePath once it is done
+
+    budget = How many seconds per frame to spend making nodes
+
+    The other parameters are the same as for octreefy.
+    """
+    if lod: lod = (lodGrid, lodFactor)
+    return buildAsync(node, 'octree-root', splitIntoQuadrants, type, \
+        maxDensity, verbose, keepState, clean, weld, cleanEpsilon, cleanArea, \
+        lod, clip, maxGrowth, budget, callback)
+
+def quadtreefyAsync(node, callback=None, budget=0.002, type='geom', \
+    maxDensity=4, verbose=0, keepState=False, clean=False, weld=False, \
+    cleanEpsilon=1e-4, cleanArea=1e-8, lod=False, lodGrid=4, lodFactor=4.0, \
+    clip=False, maxGrowth=2.0):
+    """
+    Quadtreefy this node in the background, returns a TreeBuild.
+
+    callback = Called with the quadtree NodePath once it is done
+
+    budget = How many seconds per frame to spend making nodes
+
+    The other parameters are the same as for quadtreefy.
+    """
+    if lod: lod = (lodGrid, lodFactor)
+    return buildAsync(node, 'quadtree-root', splitInto2DQuads, type, \
+        maxDensity, verbose, keepState, clean, weld, cleanEpsilon, cleanArea, \
+        lod, clip, maxGrowth, budget, callback)
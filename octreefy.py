@@ -22,6 +22,8 @@
      an octree for this node and a seperate octree for each 
      child of this node returns the octree as a node. only vertex     
      information is transfered to this new node
+     use octreefy(node,clean=True) to drop zero area and
+     duplicated triangles before the octree is built
 """
 __all__ = ['octreefy']
 from pandac.PandaModules import *
@@ -99,9 +101,39 @@ def genPolyWraps(vdata,prim):
         pw.center = center
         yield pw
         
-def buildOctree(vdata,prim,maxNumber,verbose):
+def cleanPolyWraps(polywraps,vdata,prim,epsilon=1e-6):
+    """
+        drop zero area and duplicated triangles (same winding), points closer
+        than epsilon count as the same. returns the polywraps
+        that are kept and the number of dropped ones
+    """
+    vertex = GeomVertexReader(vdata,'vertex')
+    seen = set()
+    kept = []
+    for pw in polywraps:
+        s = prim.getPrimitiveStart(pw.polygon)
+        e = prim.getPrimitiveEnd(pw.polygon)
+        points = []
+        for i in range(s,e):
+            vertex.setRow(prim.getVertex(i))
+            points.append(Point3(vertex.getData3f()))
+        area = (points[1]-points[0]).cross(points[2]-points[0]).length()/2
+        if area <= epsilon*epsilon: continue
+        keys = [tuple([int(round(x/epsilon)) for x in p]) for p in points]
+        # rotate the smallest key first, so the winding still counts
+        first = keys.index(min(keys))
+        key = tuple(keys[first:]+keys[:first])
+        if key in seen: continue
+        seen.add(key)
+        kept.append(pw)
+    return kept,len(polywraps)-len(kept)
+        
+def buildOctree(vdata,prim,maxNumber,verbose,clean=False):
     """ build an octree from a primitive and vertex data """
     polywraps = [i for i in genPolyWraps(vdata,prim)]
+    if clean:
+        polywraps,dropped = cleanPolyWraps(polywraps,vdata,prim)
+        if verbose: print dropped,"degenerate or duplicate triangles dropped"
     if verbose: print len(polywraps),"triangles"
     center = getCenter(polywraps)
     quadrants = splitIntoQuadrants(polywraps,center)
@@ -221,7 +253,7 @@ def combine(node):
             startingPos=pos
     return [newVdata,newPrim]
             
-def octreefy(node,maxNumber=3,verbose=False):
+def octreefy(node,maxNumber=3,verbose=False,clean=False):
     """
         octreefy this node and it's children
         using the buildOctree functions
@@ -229,4 +261,4 @@ def octreefy(node,maxNumber=3,verbose=False):
     vdata,prim = combine(node)    #combine all of the geoms into one vertex/triangle list
     #print vdata
     #print prim
-    return buildOctree(vdata,prim,maxNumber,verbose)    #build the octree 
+    return buildOctree(vdata,prim,maxNumber,verbose,clean)    #build the octree 